@@ -7,69 +7,173 @@ import argparse
 import sys
 import ipaddress
 import csv
-from openpyxl import Workbook
-from openpyxl import load_workbook
+import json
+import functools
 
+# Columns of the Athena VPC flow log query CSV, see process_vpc_flog_logs.py
+FLOWLOG_COLUMNS = [ 'src','dest','numpackets','lines' ]
 
-def excel_to_cidr_dict(excel_filename, show_warnings=False):
+
+def address_to_int(address):
+  '''
+  Pack a dotted IPv4 address into an integer, eg. '10.123.4.5' -> 175834117.
+  A legacy 3 octet /24 prefix such as '10.123.4' is packed as '10.123.4.0'.
+  This is much cheaper than creating an ipaddress.IPv4Address per flow.
+  Raises ValueError if the address is not valid.
+  '''
+  octets = address.split('.')
+  if len(octets) == 3:
+    octets.append('0')
+  if len(octets) != 4:
+    raise ValueError(f'{address} is not an IPv4 address')
+  address_int = 0
+  for octet in octets:
+    # Only plain ASCII digits, int() would also accept eg. ' 1', '+1' or '1_0':
+    if not (octet.isascii() and octet.isdigit()):
+      raise ValueError(f'{address} is not an IPv4 address')
+    octet = int(octet)
+    if not 0 <= octet <= 255:
+      raise ValueError(f'{address} is not an IPv4 address')
+    address_int = (address_int << 8) | octet
+  return address_int
+
+
+class CidrTable:
   '''
-  Takes an Excel file with the following columns:
+  Longest-prefix-match table of IPv4 CIDRs -> network info dict.
+
+  Each CIDR is stored once, in a hash map for its prefix length, keyed by the
+  network part of the address as an integer. A lookup walks the prefix lengths
+  from the longest to the shortest, so it costs at most one dict lookup per
+  distinct prefix length in the table (typically just a handful).
+
+  Sample usage:
+    table = CidrTable()
+    table['10.123.0.0/23'] = {'name': 'Some VPC'}
+    table['10.123.1.17']  # -> {'name': 'Some VPC'}
+    table['10.123.1']     # legacy 3 octet /24 prefix, same as '10.123.1.0'
+  '''
+
+  def __init__(self):
+    # prefix length -> { network address >> host bits : information }
+    self._tables = {}
+
+  def __setitem__(self, cidr, information):
+    # strict=False masks off any host bits, eg. 10.123.1.5/23 -> 10.123.0.0/23.
+    # Raises ValueError (AddressValueError/NetmaskValueError) if not an IPv4 CIDR.
+    network = ipaddress.IPv4Network(cidr, strict=False)
+    prefixlen = network.prefixlen
+    if prefixlen not in self._tables:
+      self._tables[prefixlen] = {}
+      # Keep the prefix lengths sorted longest first, so the first match wins:
+      self._tables = dict(sorted(self._tables.items(), reverse=True))
+    # Only the integer network address is kept, no per-subnet objects or strings:
+    self._tables[prefixlen][int(network.network_address) >> (32 - prefixlen)] = information
+
+  def get(self, address, default=None):
+    ''' Returns the information of the longest CIDR containing address, or default '''
+    try:
+      address_int = address_to_int(address)
+    except ValueError:
+      return default
+    for prefixlen, table in self._tables.items():
+      information = table.get(address_int >> (32 - prefixlen))
+      if information is not None:
+        return information
+    return default
+
+  def __getitem__(self, address):
+    information = self.get(address)
+    if information is None:
+      raise KeyError(address)
+    return information
+
+  def __len__(self):
+    return sum(len(table) for table in self._tables.values())
+
+
+def read_csv_values(csv_filename):
+  ''' Yields the values of each row of a CSV file, after the header. Empty values are None. '''
+  with open(csv_filename, 'r', newline='') as csvfile:
+    csvreader = csv.reader(csvfile)
+    next(csvreader, None)  # Skip header
+    for row in csvreader:
+      yield [ value or None for value in row ]
+
+
+def read_xlsx_values(excel_filename):
+  ''' Yields the values of each row of the first sheet of an Excel file, after the header. '''
+  # openpyxl is only needed for the legacy Excel format:
+  from openpyxl import load_workbook
+  wb = load_workbook(filename=excel_filename, read_only=True)
+  try:
+    # values_only yields plain tuples of values, so no Cell object is created per cell:
+    yield from wb.active.iter_rows(min_row=2, values_only=True)
+  finally:
+    wb.close()
+
+
+def read_network_rows(network_filename):
+  '''
+  Takes a CSV file (or a legacy Excel .xlsx file) with the following columns:
       'cidr','account_id','name','vpc_id','associate_with','propagate_to'
-  and converts it into a hash map (dictionary) of /24 CIDRs -> network info dict.
-  It is converted to /24 blocks because the Athena CSV file is uses /24 blocks.
+  and yields a network info dict per row.
 
-  Sample input Excel:
-    10.123.0.0/23 | 012345678912 | Some VPC | vpc-abcd12345 | Isolated | Infrastructure,Onpremises
+  Sample input CSV (propagate_to can also be a JSON list, eg. "[""Infrastructure"", ""Onpremises""]"):
+    10.123.0.0/23,012345678912,Some VPC,vpc-abcd12345,Isolated,"Infrastructure,Onpremises"
   Sample output:
-  {
-    '10.123.0' : {
+    {
       'cidr': '10.123.0.0/23',
       'account_id': '000000000000',
       'name': 'Some VPC',
       'vpc_id': 'vpc-abcd12345',
       'associate_with': 'Isolated',
-      'propagate_to': [
+      'propagate_to': frozenset({
         'Infrastructure',
         'Onpremises'
-      ]
-    },
-    '10.123.1' : {
-      'cidr': '10.123.0.0/23',
-      'account_id': '000000000000',
-      'name': 'Some VPC',
-      'vpc_id': 'vpc-abcd12345',
-      'associate_with': 'Isolated',
-      'propagate_to': [
-        'Infrastructure',
-        'Onpremises'
-      ]
-    }    
-  }
+      })
+    }
   '''
 
-  return_dict = {}
-
-  # Iterate through Excel file:
   header = [ 'cidr','account_id','name','vpc_id','associate_with','propagate_to' ]
-  wb = load_workbook(filename=excel_filename, read_only=True)
-  sheet = wb.active
-  for row in sheet.iter_rows(min_row=2):
-    cidr = row[header.index('cidr')].value
+  if network_filename.lower().endswith('.xlsx'):
+    rows = read_xlsx_values(network_filename)
+  else:
+    rows = read_csv_values(network_filename)
+  for row in rows:
+    # The columns are in the order of the header above, missing trailing columns are empty:
+    cidr, account_id, name, vpc_id, associate_with, propagate_to_str = (list(row) + [None] * len(header))[:len(header)]
+    if not cidr:
+      # Skip empty rows, eg. formatted but unused rows at the end of the sheet
+      continue
     # Remove spaces, for example "10.215.96.0 /21" -> "10.215.96.0/21"
     cidr = cidr.replace(' ', '')
-    account_id = row[header.index('account_id')].value
-    name = row[header.index('name')].value
-    vpc_id = row[header.index('vpc_id')].value
-    associate_with = row[header.index('associate_with')].value
-    propagate_to_str = row[header.index('propagate_to')].value
-
-    if propagate_to_str:
-      propagate_to = [ x.strip() for x in propagate_to_str.split(',') ]
+    # Store the CIDR as it is matched, eg. 10.123.1.5/23 -> 10.123.0.0/23, see CidrTable.
+    # Invalid CIDRs are kept as they are, and reported when adding them to the CidrTable.
+    try:
+      cidr = ipaddress.IPv4Network(cidr, strict=False).with_prefixlen
+    except ValueError:
+      pass
+
+    # A frozenset, as every flow checks the src association against it.
+    # The generator writes a JSON list, eg. ["Flat", "Onpremises"], which needs no
+    # string processing, but a hand written comma separated list also works:
+    if propagate_to_str and propagate_to_str.startswith('['):
+      try:
+        propagate_to = json.loads(propagate_to_str)
+      except ValueError:
+        propagate_to = None
+      if not isinstance(propagate_to, list) or not all(isinstance(x, str) for x in propagate_to):
+        print(f'The propagate_to of {cidr} ({name}) is not a JSON list of names: {propagate_to_str}')
+        print('Use eg. ["Flat", "Infra"] (with double quotes), or a comma separated list: Flat,Infra')
+        sys.exit(1)
+      propagate_to = frozenset(propagate_to)
+    elif propagate_to_str:
+      propagate_to = frozenset(x.strip() for x in propagate_to_str.split(','))
     else:
-      propagate_to = []
+      propagate_to = frozenset()
 
-    # The memory required for the info dict is shared for a CIDR split into several /24 blocks, as it's a pointer:
-    information = {
+    yield {
         'cidr': cidr,
         'account_id': account_id,
         'name': name,
@@ -78,104 +182,168 @@ def excel_to_cidr_dict(excel_filename, show_warnings=False):
         'propagate_to': propagate_to
     }
 
-    # Split the CIDR into /24 blocks:
-    try:
-      for cidr24 in ipaddress.ip_network(cidr).subnets(new_prefix=24):
-        cidr24_string = cidr24.exploded
-        # Convert 10.123.4.0/24 -> 10.123.4
-        # This is to match the columns in the Athena CSV output.
-        key = ".".join(cidr24_string.split('.')[:3])
 
-        return_dict[key] = information
+def excel_to_cidr_dict(network_filename, show_warnings=False):
+  '''
+  Takes a CSV or Excel file in the format described in read_network_rows
+  and converts it into a longest-prefix-match table of CIDRs -> network info dict.
+  Any address within a CIDR (full address or legacy 3 octet /24 prefix) can be
+  looked up in it, see CidrTable. Each network is numbered by its row, 'index'.
+
+  Every association name is also given a bit, so the route table check is a
+  single AND: src 'associate_bit' & dst 'propagate_mask' is 0 if it fails.
+
+  Sample output:
+  CidrTable {
+    '10.123.0.0/23' : {
+      'cidr': '10.123.0.0/23',
+      'account_id': '000000000000',
+      'name': 'Some VPC',
+      'vpc_id': 'vpc-abcd12345',
+      'associate_with': 'Isolated',
+      'propagate_to': frozenset({
+        'Infrastructure',
+        'Onpremises'
+      }),
+      'associate_bit': 0b001,
+      'propagate_mask': 0b110,
+      'index': 0
+    }
+  }
+  '''
+
+  return_table = CidrTable()
+  # Association name -> bit, assigned in the order the names are first seen:
+  association_bits = {}
+  for index, information in enumerate(read_network_rows(network_filename)):
+    # A small integer to identify the network, eg. to deduplicate failed network pairs:
+    information['index'] = index
+    for association in (information['associate_with'], *information['propagate_to']):
+      if association and association not in association_bits:
+        association_bits[association] = 1 << len(association_bits)
+    # A missing association gets no bit, so it fails against every propagation:
+    information['associate_bit'] = association_bits.get(information['associate_with'], 0)
+    information['propagate_mask'] = 0
+    for association in information['propagate_to']:
+      # Empty items, eg. from "Flat," or "Flat, ,Infra", have no bit and match nothing:
+      if association:
+        information['propagate_mask'] |= association_bits[association]
+
+    try:
+      return_table[information['cidr']] = information
     except ValueError:
       if show_warnings:
-        print(f'Skipping {cidr} ({name}), shorter than /24. ')
+        print(f'Skipping {information["cidr"]} ({information["name"]}), not a valid IPv4 CIDR. ')
+
+  return return_table
+
+
+def score_flows(flows, info):
+  '''
+  Checks every (src, dest) address pair in flows against the CIDR table info,
+  as returned by excel_to_cidr_dict.
+  This is the hot loop over every flow log row, so it only does cached lookups
+  and integer operations on local variables per flow.
+  Returns (success_count, failed_count, unmatched_count, failed_pairs, unmatched_addresses),
+  where failed_pairs maps a (src, dst) network pair ID to the (src_info, dst_info)
+  of each failed network pair, see failure_message, and unmatched_addresses is the
+  set of addresses not in any CIDR.
+  '''
+
+  # Deduplicate failures by network pair, as there are many flows for each VPC CIDR pair.
+  # The pair is packed into one integer, the message is only formatted once per pair at the end.
+  failed_pairs = {}
+  unmatched_addresses = set()
+  success_count = 0
+  failed_count = 0
+  unmatched_count = 0
+
+  # The same addresses show up in many flows, so only walk the CIDR table once per address.
+  # get() returns None for unmatched addresses, so these are cached too and no exception is raised:
+  lookup = functools.lru_cache(maxsize=None)(info.get)
+
+  for src, dst in flows:
+    src_info = lookup(src)
+    dst_info = lookup(dst)
+    if src_info is None or dst_info is None:
+      unmatched_count += 1
+      unmatched_addresses.add(src if src_info is None else dst)
+      continue
+
+    # Check if src can reach dest, ie. the src association is in the dest propagations:
+    if src_info['associate_bit'] & dst_info['propagate_mask']:
+      success_count += 1
+    else:
+      failed_count += 1
+      pair_id = (src_info['index'] << 32) | dst_info['index']
+      if pair_id not in failed_pairs:
+        failed_pairs[pair_id] = (src_info, dst_info)
+
+  return success_count, failed_count, unmatched_count, failed_pairs, unmatched_addresses
+
+
+def failure_message(src_info, dst_info):
+  ''' Explain why src_info cannot communicate with dst_info '''
+  return f'{src_info["cidr"]} (src name: {src_info["name"]}, src id: {src_info["vpc_id"]}) cannot communicate with {dst_info["cidr"]} (dst name: {dst_info["name"]}, dst id: {dst_info["vpc_id"]}) , because the src association {src_info["associate_with"]} is not in the dest propagations {sorted(dst_info["propagate_to"])}'
+
 
-  wb.close()
-  return return_dict
-  
 def main():
   # Process arguments:
   parser = argparse.ArgumentParser()
   parser.add_argument('--flowlogcsv', required=True,
                       help='Path to the Athena VPC flow log query CSV')
-  parser.add_argument('--xlsx', required=True,
-                      help='Path to the network CIDR/VPC associations/propagations mapping XLSX')
+  parser.add_argument('--network', '--xlsx', dest='network', required=True,
+                      help='Path to the network CIDR/VPC associations/propagations mapping CSV (or legacy XLSX)')
   parser.add_argument('--show-warnings', action='store_true', help='Show unmatched CIDRs')
                       
   args = parser.parse_args()
 
-  xlsx_filename = args.xlsx
+  network_filename = args.network
   flowlog_filename = args.flowlogcsv
   show_warnings = args.show_warnings
-  for filename in (xlsx_filename, flowlog_filename):
+  for filename in (network_filename, flowlog_filename):
     if not os.path.isfile(filename):
       print(f'{filename} does not exist.')
       sys.exit(1)
 
-  # Use this set() to deduplicate the output strings, as there are many /24s for each VPC CIDR
-  failed_strings = set()
-  warning_strings = set()
+  # Get CIDR to information table:
+  info = excel_to_cidr_dict(network_filename, show_warnings)
 
-  # Get 24/CIDR to information dict:
-  info = excel_to_cidr_dict(xlsx_filename, show_warnings)
-  
   # Process each flow log csv line:
-  with open(flowlog_filename, 'r') as flowlogfile:
-    csvreader = csv.DictReader(flowlogfile)
-    next(csvreader, None) # Skip header
-    total_count = 0
-    failed_count = 0
-    success_count = 0
-    unmatched_count = 0
-    for row in csvreader:
-      total_count += 1
-      src = row['src']
-      dst = row['dest']
-      numpackets = row['numpackets']
+  with open(flowlog_filename, 'r', newline='') as flowlogfile:
+    csvreader = csv.reader(flowlogfile)
+    # csv.reader returns the header as the first row, the data rows follow:
+    header = next(csvreader, [])
+    missing_columns = [ column for column in FLOWLOG_COLUMNS if column not in header ]
+    if missing_columns:
+      print(f'{flowlog_filename} does not look like the Athena query output, it is missing the columns {missing_columns}.')
+      sys.exit(1)
+    # Only the src and dest columns are needed. Short (eg. truncated) rows have no
+    # addresses, so they are counted as unmatched instead of aborting the run:
+    src_index = header.index('src')
+    dst_index = header.index('dest')
+    min_length = max(src_index, dst_index) + 1
+    flows = ((row[src_index], row[dst_index]) if len(row) >= min_length else ('', '') for row in csvreader)
+    success_count, failed_count, unmatched_count, failed_pairs, unmatched_addresses = score_flows(flows, info)
+  total_count = success_count + failed_count + unmatched_count
 
-      try:
-        src_association = info[src]['associate_with']
-        src_name = info[src]['name']
-        src_vpc_id = info[src]['vpc_id']
-        src_cidr = info[src]['cidr']
-
-        dst_propagations = info[dst]['propagate_to']
-        dst_name = info[dst]['name']
-        dst_vpc_id = info[dst]['vpc_id']
-        dst_cidr = info[dst]['cidr']
-      except KeyError as e:
-        unmatched_count += 1
-        if show_warnings:
-          result = f'Warning: no entry for {e}'
-          warning_strings.add(result)
-          continue
-
-      # Check if src can reach dest:
-      if src_association not in dst_propagations:
-        failed_count += 1
-        result = f'{src_cidr} (src name: {src_name}, src id: {src_vpc_id}) cannot communicate with {dst_cidr} (dst name: {dst_name}, dst id: {dst_vpc_id}) , because the src association {src_association} is not in the dest propagations {dst_propagations}'
-        failed_strings.add(result)
-      else:
-        success_count += 1
-
-    # Finally print the summary:
-    for result in failed_strings:
-      print(result)
-
-    if show_warnings:
-      for result in warning_strings:
-        print(result)
-
-    print('')
-    print(f'Total processed rows: {total_count}')
-    print(f'Unmatched rows: {unmatched_count}')
-    print(f'Successful rows: {success_count}')
-    print(f'Failed rows: {failed_count}')
-    print(f'Deduplicated failed rows: {len(failed_strings)}')
-
-    if unmatched_count > 0 and not show_warnings:
-      print('\nRepeat the command with --show-warnings to see unmatched entries')
+  # Finally print the summary:
+  for src_info, dst_info in failed_pairs.values():
+    print(failure_message(src_info, dst_info))
+
+  if show_warnings:
+    for address in unmatched_addresses:
+      print(f"Warning: no entry for '{address}'")
+
+  print('')
+  print(f'Total processed rows: {total_count}')
+  print(f'Unmatched rows: {unmatched_count}')
+  print(f'Successful rows: {success_count}')
+  print(f'Failed rows: {failed_count}')
+  print(f'Deduplicated failed rows: {len(failed_pairs)}')
+
+  if unmatched_count > 0 and not show_warnings:
+    print('\nRepeat the command with --show-warnings to see unmatched entries')
 
 
 if __name__ == '__main__':
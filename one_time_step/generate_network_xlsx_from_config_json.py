@@ -7,16 +7,13 @@ import json
 import sys
 import os
 import argparse
-from openpyxl import Workbook
+import csv
 
 EXCLUDE_CIDRs = ('10.123.123.0/32')
 
-xlsx = Workbook()
-sheet = xlsx.active
-
 parser = argparse.ArgumentParser()
 parser.add_argument('--configjson', required=True, type=argparse.FileType('r'), help='Path to config VPC JSON query results.')
-parser.add_argument('--output', required=True, help='Path to Excel file to write to.')
+parser.add_argument('--output', required=True, help='Path to the CSV file to write to. A path ending in .xlsx writes a (legacy) Excel file instead.')
 
 args = parser.parse_args()
 # Load it as a python dict
@@ -32,10 +29,9 @@ if os.path.isfile(args.output):
   print(f'Error: The output file {args.output} already exists.')
   sys.exit(1)
 
-
-# Print header:
+# Build all the rows first, so an error in the input does not leave a partial output file:
 header = [ 'cidr','account_id','name','vpc_id','associate_with','propagate_to' ]
-sheet.append(header)
+rows = [ header ]
 
 for result in results:
   configuration = result.get('configuration', {})
@@ -52,10 +48,21 @@ for result in results:
         raise Exception(f'{vpc_name} ({vpc_id}) has a comma in it')
       vpc_name = tag['value']
 
-  # Print the output as a CSV, see header before the for loop:
-  row = [ cidr, account_id, vpc_name, vpc_id, "", "" ]
-  sheet.append(row)
+  # Print the output as a CSV, see header before the for loop.
+  # propagate_to is a JSON list, so check_flows.py can load it without splitting strings:
+  row = [ cidr, account_id, vpc_name, vpc_id, "", json.dumps([]) ]
+  rows.append(row)
 
-xlsx.save(args.output)
+if args.output.lower().endswith('.xlsx'):
+  # openpyxl is only needed for the legacy Excel format
+  from openpyxl import Workbook
+  # Write-only mode streams the rows to disk on save, instead of keeping a Cell object per cell:
+  xlsx = Workbook(write_only=True)
+  sheet = xlsx.create_sheet()
+  for row in rows:
+    sheet.append(row)
+  xlsx.save(args.output)
+else:
+  with open(args.output, 'w', newline='') as csvfile:
+    csv.writer(csvfile).writerows(rows)
 print(f'Successfully written to {args.output}')
-
@@ -9,7 +9,12 @@ import csv
 import datetime
 import time
 import uuid
+import concurrent.futures
+import ipaddress
 import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from check_flows import read_network_rows
 
 S3_BUCKET = 'fillme'
 S3_ATHENA_BUCKET = S3_BUCKET
@@ -17,6 +22,27 @@ REGION = 'ap-southeast-2'
 START_DATE = datetime.date(2024, 2, 22)
 END_DATE = datetime.date(2024, 2, 23)  # Day *after* the last day to process
 OUTPUT_FILENAME = 'athena.csv'
+# Optional: the network plan CSV (or XLSX) used by check_flows.py. If set, the plan is
+# joined with the flow logs in Athena, and only flows that may fail are downloaded.
+NETWORK_FILENAME = None
+# Partitions added per ALTER TABLE query, keeps the query well below Athena's query length limit
+PARTITIONS_PER_QUERY = 100
+# ALTER TABLE queries run at the same time, stays below Athena's default DDL query quota
+MAX_CONCURRENT_QUERIES = 10
+
+# Download large query results in 64 MB parts, 32 parts at a time
+DOWNLOAD_CONFIG = TransferConfig(
+    multipart_chunksize=64 * 1024 * 1024,
+    max_concurrency=32,
+    use_threads=True)
+
+# Clients are created once and reused, the Athena client is shared by all threads running queries
+athena_client = boto3.client('athena', region_name=REGION)
+# The S3 connection pool must fit all the download threads, botocore's default is only 10
+s3_client = boto3.client(
+    's3',
+    region_name=REGION,
+    config=Config(max_pool_connections=DOWNLOAD_CONFIG.max_request_concurrency))
 
 
 
@@ -37,19 +63,20 @@ def create_request_token():
 
 def run_sql(query_string):
     """ Run a Athena SQL """
-    athena_client = boto3.client('athena', region_name=REGION)
     response = athena_client.start_query_execution(
         ClientRequestToken=create_request_token(),
         ResultConfiguration={"OutputLocation": f"s3://{S3_ATHENA_BUCKET}/athena/"},
         QueryString=query_string)
     query_id = response['QueryExecutionId']
 
+    delay = 0.1
     while True:
         response = athena_client.get_query_execution(QueryExecutionId=query_id)
         status = response['QueryExecution']['Status']['State']
         if status in ('QUEUED', 'RUNNING', 'SCHEDULED'):
-            # Still running
-            time.sleep(0.1)
+            # Still running, back off up to 1 second for long running queries
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
         elif status in ('FAILED', 'CANCELLED'):
             if 'AlreadyExistsException' in (
                     response['QueryExecution']['Status']['StateChangeReason']):
@@ -91,25 +118,79 @@ def create_table(accounts):
             TBLPROPERTIES ('skip.header.line.count'='1')
             """)
 
+    partitions = []
     for account in accounts:
         for date in get_days():
             datestr = date.strftime('%Y-%m-%d')
             year = date.strftime('%Y')
             month = date.strftime('%m')
             day = date.strftime('%d')
-            print(f"Adding partition for {account} on {datestr}", file=sys.stderr)
-            run_sql(f"""
-              ALTER TABLE vpc_flow_logs
-              ADD PARTITION (day='{datestr}', account='{account}')
+            partitions.append(f"""
+              PARTITION (day='{datestr}', account='{account}')
               location 's3://{S3_BUCKET}/vpc-flow-logs/AWSLogs/{account}/vpcflowlogs/{REGION}/{year}/{month}/{day}'
             """)
 
+    # Add the partitions in batches, rather than running one query per partition,
+    # and run the batches concurrently as they are independent:
+    print(f"Adding {len(partitions)} partitions", file=sys.stderr)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_QUERIES) as executor:
+        futures = []
+        for start in range(0, len(partitions), PARTITIONS_PER_QUERY):
+            batch = partitions[start:start + PARTITIONS_PER_QUERY]
+            futures.append(executor.submit(run_sql, f"""
+              ALTER TABLE vpc_flow_logs
+              ADD IF NOT EXISTS {''.join(batch)}
+            """))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()  # Raise any query failure
+
+
+def create_cidr_map_table(network_filename):
+    """ Upload the network plan CIDRs to S3, and create the Athena table over it
+
+    Like CidrTable in check_flows.py, each CIDR is keyed by its prefix length and
+    its network address divided by the CIDR size (network_key), so addresses can
+    be matched with equality joins instead of a contains() test per CIDR.
+    """
+    print(f"Uploading {network_filename} to the cidr_map table", file=sys.stderr)
+    lines = []
+    for information in read_network_rows(network_filename):
+        try:
+            network = ipaddress.IPv4Network(information['cidr'], strict=False)
+        except ValueError:
+            continue  # check_flows.py reports these as unmatched
+        network_key = int(network.network_address) >> (32 - network.prefixlen)
+        associate_with = information['associate_with'] or ''
+        propagate_to = ','.join(sorted(information['propagate_to']))
+        lines.append(
+            f"{network.with_prefixlen}\t{network.prefixlen}\t{network_key}"
+            f"\t{associate_with}\t{propagate_to}\n")
+    s3_client.put_object(
+        Bucket=S3_ATHENA_BUCKET,
+        Key='cidr_map/cidr_map.tsv',
+        Body=''.join(lines).encode())
+
+    # Recreate the table, in case it was created with an older layout
+    run_sql("DROP TABLE IF EXISTS cidr_map")
+    run_sql(f"""
+            CREATE EXTERNAL TABLE cidr_map (
+              cidr string,
+              prefixlen int,
+              network_key bigint,
+              associate_with string,
+              propagate_to array<string>
+              )
+            ROW FORMAT DELIMITED
+            FIELDS TERMINATED BY '\\t'
+            COLLECTION ITEMS TERMINATED BY ','
+            LOCATION 's3://{S3_ATHENA_BUCKET}/cidr_map/'
+            """)
+
 
 def main():
     """ main """
-    s3client = boto3.client('s3', region_name=REGION)
     accounts = []
-    for account in s3client.list_objects_v2(
+    for account in s3_client.list_objects_v2(
             MaxKeys=10000,
             Bucket=S3_BUCKET,
             Prefix='vpc-flow-logs/AWSLogs/',
@@ -119,46 +200,87 @@ def main():
 
     create_table(accounts)
 
-    print("Running query", file=sys.stderr)
-    s3location = run_sql("""
+    query = """
+        WITH flows AS (
+          SELECT
+            sourceaddress,
+            destinationaddress,
+            numpackets,
+            -- Split each address once, try_cast as NODATA records have '-' addresses:
+            try_cast(split_part(sourceaddress, '.', 1) AS integer) AS s1,
+            try_cast(split_part(sourceaddress, '.', 2) AS integer) AS s2,
+            try_cast(split_part(destinationaddress, '.', 1) AS integer) AS d1,
+            try_cast(split_part(destinationaddress, '.', 2) AS integer) AS d2
+          FROM "default"."vpc_flow_logs"
+          WHERE action = 'ACCEPT'
+        )
         SELECT
-            array_join(slice(split(sourceaddress, '.'), 1, 3), '.') as src,
-            array_join(slice(split(destinationaddress, '.'), 1, 3), '.') as dest,
+            sourceaddress as src,
+            destinationaddress as dest,
             sum(numpackets) as numpackets,
             count(*) as lines
-        FROM "default"."vpc_flow_logs"
-        WHERE action = 'ACCEPT'
-        AND (
-          array_join(slice(split(sourceAddress, '.'), 1, 1), '.') = '10'
-          OR (
-            array_join(slice(split(sourceAddress, '.'), 1, 1), '.') = '192'
-            AND array_join(slice(split(sourceAddress, '.'), 1, 1), '.') = '168'
-            )
-          OR (
-            array_join(slice(split(sourceAddress, '.'), 1, 1), '.') = '172'
-            AND cast(array_join(slice(split(sourceAddress, '.'), 1, 1), '.') as integer) >= 16
-            AND cast(array_join(slice(split(sourceAddress, '.'), 1, 1), '.') as integer) <= 31
-            )
-          )
-        AND (
-          array_join(slice(split(destinationaddress, '.'), 1, 1), '.') = '10'
-          OR (
-            array_join(slice(split(destinationaddress, '.'), 1, 1), '.') = '192'
-            AND array_join(slice(split(destinationaddress, '.'), 1, 1), '.') = '168'
-            )
-          OR (
-            array_join(slice(split(destinationaddress, '.'), 1, 1), '.') = '172'
-            AND cast(array_join(slice(split(destinationaddress, '.'), 1, 1), '.') as integer) >= 16
-            AND cast(array_join(slice(split(destinationaddress, '.'), 1, 1), '.') as integer) <= 31
-            )
-          )
+        FROM flows
+        -- Only private (RFC 1918) addresses: 10/8, 172.16/12 and 192.168/16
+        WHERE (s1 = 10 OR (s1 = 172 AND s2 BETWEEN 16 AND 31) OR (s1 = 192 AND s2 = 168))
+        AND (d1 = 10 OR (d1 = 172 AND d2 BETWEEN 16 AND 31) OR (d1 = 192 AND d2 = 168))
         GROUP BY (1, 2)
-        """)
+        """
+
+    if NETWORK_FILENAME:
+        create_cidr_map_table(NETWORK_FILENAME)
+        # The join below reads the summary several times, and Athena re-runs a CTE
+        # for every reference. Store it in a table (CTAS, written under the query
+        # results location) first, so the flow logs are only scanned once:
+        print("Summarizing flows to the flow_summary table", file=sys.stderr)
+        run_sql("DROP TABLE IF EXISTS flow_summary")
+        run_sql(f"CREATE TABLE flow_summary AS {query}")
+        # Match every distinct address to its longest matching CIDR: for each
+        # prefix length in the plan, the address divided by the CIDR size must
+        # equal the CIDR's network_key. These are equality joins, the cross join
+        # only multiplies the addresses by the handful of distinct prefix lengths.
+        # Then keep only the flows which have no matching CIDR, or where the dest
+        # CIDR does not propagate to the src CIDR's association. check_flows.py
+        # does the final check, and the reporting, on these flows.
+        query = f"""
+            WITH addresses AS (
+              SELECT address,
+                CAST(split_part(address, '.', 1) AS bigint) * 16777216
+                + CAST(split_part(address, '.', 2) AS bigint) * 65536
+                + CAST(split_part(address, '.', 3) AS bigint) * 256
+                + CAST(split_part(address, '.', 4) AS bigint) AS address_int
+              FROM (SELECT src AS address FROM flow_summary UNION SELECT dest FROM flow_summary)
+            ),
+            prefixes AS (
+              SELECT DISTINCT prefixlen, CAST(power(2, 32 - prefixlen) AS bigint) AS size
+              FROM cidr_map
+            ),
+            matches AS (
+              SELECT a.address,
+                max_by(m.associate_with, m.prefixlen) AS associate_with,
+                max_by(m.propagate_to, m.prefixlen) AS propagate_to
+              FROM addresses a
+              CROSS JOIN prefixes p
+              JOIN cidr_map m
+                ON m.prefixlen = p.prefixlen
+                AND m.network_key = a.address_int / p.size
+              GROUP BY a.address
+            )
+            SELECT f.src, f.dest, f.numpackets, f.lines
+            FROM flow_summary f
+            LEFT JOIN matches src_m ON src_m.address = f.src
+            LEFT JOIN matches dst_m ON dst_m.address = f.dest
+            WHERE src_m.address IS NULL
+            OR dst_m.address IS NULL
+            OR src_m.associate_with = ''
+            OR NOT contains(dst_m.propagate_to, src_m.associate_with)
+            """
+
+    print("Running query", file=sys.stderr)
+    s3location = run_sql(query)
     print(f"Retrieving results to {OUTPUT_FILENAME}", file=sys.stderr)
     (_, _, bucket, key) = s3location.split('/', maxsplit=3)
-    client = boto3.client('s3')
     with open(OUTPUT_FILENAME, 'wb') as f:
-        client.download_fileobj(bucket, key, f)
+        s3_client.download_fileobj(bucket, key, f, Config=DOWNLOAD_CONFIG)
 
 
 if __name__ == "__main__":